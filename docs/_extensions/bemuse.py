@@ -1,5 +1,6 @@
 
-from os import system
+import subprocess
+import sys
 from docutils import nodes
 from docutils.parsers.rst import Directive
 
@@ -25,7 +26,9 @@ def autolink(pattern):
     return role
 
 def autogen(app):
-    system('python generate.py')
+    # Run the generator with the same Python that runs Sphinx, and fail
+    # the build on errors instead of silently using stale codedoc files.
+    subprocess.check_call([sys.executable, 'generate.py'])
 
 class Codedoc(Directive):
     required_arguments = 1
@@ -57,7 +60,7 @@ class SourceLinkRegion(object):
     def hash(self):
         text = re.sub(r'[^\w]', '', '\n'.join(self.contents))
         sha = hashlib.sha1()
-        sha.update(text)
+        sha.update(text.encode('utf-8'))
         return sha.hexdigest()[0:8]
 
 class SourceLinkParser(object):
@@ -1,10 +1,10 @@
 
 # http://stackoverflow.com/questions/2186525/use-a-glob-to-find-files-recursively-in-python
+import mmap
+import multiprocessing
 import os
 import re
 import errno
-import fnmatch
-from itertools import chain
 
 # >> docs/generate
 # The code documentation and module documentations are generated by a Python
@@ -20,18 +20,35 @@ from itertools import chain
 # Source code files that matches the pattern ``src/**/.js`` or ``docs/**/*.py``
 # will be processed to find documentation comments.
 #
+def _walk(top, ext):
+    # ``os.scandir`` reuses the file type reported by the directory itself,
+    # so walking the tree does not have to ``stat()`` every entry.
+    stack = [top]
+    while stack:
+        dirs = []
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # os.walk silently skips directories it cannot list, including
+            # a missing top directory; keep that behaviour.
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and entry.name.endswith(ext):
+                    yield entry.path
+        stack.extend(reversed(dirs))
+
 def get_source_files():
-    for root, dirnames, filenames in os.walk('../src'):
-        for filename in fnmatch.filter(filenames, '*.js'):
-            yield root + '/' + filename
-    for root, dirnames, filenames in os.walk('../docs'):
-        for filename in fnmatch.filter(filenames, '*.py'):
-            yield root + '/' + filename
+    for path in _walk('../src', '.js'):
+        yield path
+    for path in _walk('../docs', '.py'):
+        yield path
 
 def get_feature_files():
-    for root, dirnames, filenames in os.walk('../features'):
-        for filename in fnmatch.filter(filenames, '*.feature'):
-            yield root + '/' + filename
+    for path in _walk('../features', '.feature'):
+        yield path
 
 def mkpath(path):
     try:
@@ -43,59 +60,98 @@ def mkpath(path):
             raise
 
 def indent3(x):
-    return '\n'.join('   ' + line for line in x.splitlines())
-
-CODEDOC_RE      = re.compile(r'^>> (\S+)$')
-COMMENT_RE      = re.compile(r'^(?://|#)(?: (.*$)|$)')
-CLASS_RE        = re.compile(r'^(?:export )?class (\w+)')
-EXPORT_LET_RE   = re.compile(r'^export let (\w+)')
-EXPORT_FN_RE    = re.compile(r'^export function (\w+\(.*?\))')
-CONSTRUCTOR_RE  = re.compile(r'^constructor\((.*?)\) \{$')
-METHOD_RE       = re.compile(r'^(\w+\(.*?\)) {$')
-GETTER_RE       = re.compile(r'^get (\w+)\(\) {$')
-ATTRIBUTE_RE    = re.compile(r'^this.(\w+)\s*=')
+    if not x:
+        return x
+    # splitlines does not produce a line for a single trailing newline.
+    if x.endswith('\n'):
+        x = x[:-1]
+    return '   ' + x.replace('\n', '\n   ')
+
+CODEDOC_RE      = re.compile(br'^>> (\S+)$')
+BLOCK_RE        = re.compile(
+    # A run of comment lines, followed by the first non-comment line
+    # (newline-terminated, or non-empty at end of file -- a comment block
+    # that runs into EOF is discarded, as before). The lookahead sits
+    # before the whitespace so backtracking at EOF cannot turn an indented
+    # comment line into the trailing line.
+    br'((?:^[ \t]*(?://|#)[^\n]*\n)+)(?![ \t]*(?://|#))[ \t]*([^\n]*\n|[^\n]+\Z)',
+    re.M)
+CONSTRUCTOR_RE  = re.compile(br'^constructor\((.*?)\) \{$')
+METHOD_RE       = re.compile(br'^(\w+\(.*?\)) {$')
 MODULE_RE       = re.compile(r'src/(.*?)\.js$')
 
+def _is_word(s):
+    # Equivalent of matching the whole byte string against ``\w+``.
+    return bool(s) and s.replace(b'_', b'0').isalnum()
+
 class FileProcessor(object):
 
-    def __init__(self, path, root):
-        self.root = root
+    def __init__(self, path):
         self.path = path
-        self.buffer = None
+        self.events = []
+        self._module_name = None
 
-    def module_doc(self):
-        match = MODULE_RE.search(self.path)
-        modulename = match.group(1)
-        if modulename.endswith('/index'):
-            modulename = modulename[:-6]
-        return self.root.module(modulename)
+    def module_name(self):
+        # The path never changes while a file is processed, so resolve the
+        # module name once and reuse it for every block in the file.
+        name = self._module_name
+        if name is None:
+            match = MODULE_RE.search(self.path)
+            name = match.group(1)
+            if name.endswith('/index'):
+                name = name[:-6]
+            self._module_name = name
+        return name
 
     def process(self):
-        self.state = None
-        self.current_class = None
-        with open(self.path, 'r') as f:
-            for line in f:
-                self.current_line = line.strip()
-                self.process_line()
-
-    def match(self, regex):
-        match = regex.match(self.current_line)
-        self.current_match = match
-        return match
-
-    def group(self, group):
-        return self.current_match.group(group)
-
-    def process_line(self):
-        if self.match(COMMENT_RE):
-            if self.buffer is None: self.buffer = []
-            self.buffer.append(self.group(1) or '')
-        elif self.buffer is not None:
-            self.post_state = None
-            self.process_post_comment()
-            self.buffer = None
-
-    def process_post_comment(self):
+        self.current_class = False
+        # Instead of looping over every line in Python, mmap the file and
+        # let one regex pass locate the comment blocks together with the
+        # line that follows them; code outside comment blocks is skipped
+        # entirely at C speed.
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return self.events
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for block in BLOCK_RE.finditer(buf):
+                    self.process_block(block.group(1), block.group(2))
+            finally:
+                buf.close()
+        return self.events
+
+    def process_block(self, comments, trailing):
+        # Comment lines hold '//' or '#' followed by either end of line or
+        # a space and the comment text. A marker without the space is not a
+        # documentation comment: like any code line, it ends the block and
+        # is dispatched against it.
+        buffer = None
+        for line in comments.splitlines():
+            line = line.strip()
+            # BLOCK_RE already guarantees the marker, so only its length
+            # needs deciding; slicing the text out in one step avoids
+            # allocating an intermediate slice for every comment line.
+            marker = 2 if line[:2] == b'//' else 1
+            if len(line) == marker:
+                content = b''
+            elif line[marker] == 0x20:  # marker followed by a space
+                content = line[marker + 1:]
+            else:
+                if buffer is not None:
+                    self.flush(line, buffer)
+                buffer = None
+                continue
+            if buffer is None:
+                buffer = []
+            buffer.append(content)
+        if buffer is not None:
+            self.flush(trailing.strip(), buffer)
+
+    def flush(self, line, buffer):
+        self.post_state = None
+        self.process_post_comment(line, buffer)
+
+    def process_post_comment(self, line, buffer):
         if self.post_state is None:
             # >>
             # To write a block of documentation inside code (called codedoc),
@@ -105,11 +161,10 @@ class FileProcessor(object):
             #   // Documentation text goes here.
             #
             # .. codedoc:: docs/codedoc-usage
-            if CODEDOC_RE.match(self.buffer[0]):
-                match = CODEDOC_RE.match(self.buffer[0])
-                file_name = '_codedoc/%s.txt' % match.group(1)
-                codedoc = self.last_codedoc = self.root.file(file_name)
-                codedoc.add_text(self.buffer[1:])
+            codedoc_match = CODEDOC_RE.match(buffer[0])
+            if codedoc_match:
+                name = codedoc_match.group(1).decode('utf-8')
+                self.events.append(('codedoc', None, name, buffer[1:]))
 
             # >>
             # The previous codedoc can be added later by starting a block
@@ -122,85 +177,105 @@ class FileProcessor(object):
             #
             #   // >>
             #   // Some more documentation...
-            elif self.buffer[0] == '>>':
-                self.last_codedoc.add_text(self.buffer[1:])
+            elif buffer[0] == b'>>':
+                self.events.append(('continue', None, None, buffer[1:]))
 
             # >> docs/moduledoc
             # If a block of inline comment starts with ``:doc:``, then the
             # comment will be added into the module's documentation.
             #
-            elif self.buffer[0] == ':doc:':
-                module_node = self.last_codedoc = self.module_doc()
-                module_node.add_text(self.buffer[1:])
-            #
-            # If a block of inline comment starts directly before an ES6 class,
-            # it will be used as the documentation for that class::
-            #
-            #   // The Progress class holds ...
-            #   export class Progress {
-            #     constructor() {
-            #
-            # The line directly after the ``export class`` line should be a
-            # ``constructor``, which allows the script to scan the constructor's
-            # arguments.
-            #
-            elif self.match(CLASS_RE):
-                module_node = self.module_doc()
-                class_node = self.current_class = ClassNode(module_node, self.group(1))
-                module_node.add(class_node)
-                class_node.add_text(self.buffer)
-                self.post_state = 'class'
-            # >>
-            # If a method definition syntax is found directly after a block of
-            # comment, then it will be used for documenting that method::
-            #
-            #     // Reports the progress.
-            #     report(current, total, extra) {
-            elif self.current_class and self.match(METHOD_RE):
-                method_node = MethodNode(self.current_class, self.group(1))
-                method_node.add_text(self.buffer)
-                self.current_class.add(method_node)
-            # >>
-            # If a getter definition syntax or an assignment to ``this``
-            # is found after a comment block, then the comment block documents
-            # that attribute::
-            #
-            #   constructor() {
-            #     // ``true`` if the game is started, ``false`` otherwise.
-            #     this.started = false
-            #   }
-            #
-            #   // The song duration in seconds.
-            #   get duration() {
-            elif self.current_class and (self.match(GETTER_RE) or self.match(ATTRIBUTE_RE)):
-                attr_node = AttributeNode(self.current_class, self.group(1))
-                attr_node.add_text(self.buffer)
-                self.current_class.add(attr_node)
-            # >>
-            # If ``export let`` is found after a comment block, then the
-            # comment block documents that module export::
-            #
-            #   // The global SceneManager instance.
-            #   export let instance = new SceneManager()
-            elif self.match(EXPORT_LET_RE):
-                module_node = self.module_doc()
-                data_node = DataNode(module_node, self.group(1))
-                data_node.add_text(self.buffer)
-                module_node.add(data_node)
-            # >>
-            # If ``export function`` is found after a comment block, then the
-            # comment block documents that module export::
-            #
-            #   // The global SceneManager instance.
-            #   export function download() {
-            elif self.match(EXPORT_FN_RE):
-                module_node = self.module_doc()
-                data_node = DataNode(module_node, self.group(1))
-                data_node.add_text(self.buffer)
-                module_node.add(data_node)
+            elif buffer[0] == b':doc:':
+                self.events.append(('moduledoc', self.module_name(), None, buffer[1:]))
+            else:
+                # The constructs recognized below all start with a short
+                # literal keyword, so dispatch on string prefixes first and
+                # keep the regex engine out of the common case. Only method
+                # signatures are ambiguous enough to need METHOD_RE, and
+                # since METHOD_RE cannot match any of the prefixed forms it
+                # is safe to evaluate the fallback up front.
+                method_match = METHOD_RE.match(line) if self.current_class else None
+                #
+                # If a block of inline comment starts directly before an ES6 class,
+                # it will be used as the documentation for that class::
+                #
+                #   // The Progress class holds ...
+                #   export class Progress {
+                #     constructor() {
+                #
+                # The line directly after the ``export class`` line should be a
+                # ``constructor``, which allows the script to scan the constructor's
+                # arguments.
+                #
+                if line.startswith(b'class ') or line.startswith(b'export class '):
+                    parts = line.split()
+                    name = parts[2] if parts[0] == b'export' else parts[1]
+                    if _is_word(name):
+                        self.events.append(('class', self.module_name(), name.decode('utf-8'), buffer))
+                        self.current_class = True
+                        self.post_state = 'class'
+                # >>
+                # If a method definition syntax is found directly after a block of
+                # comment, then it will be used for documenting that method::
+                #
+                #     // Reports the progress.
+                #     report(current, total, extra) {
+                elif method_match:
+                    self.events.append(('method', None, method_match.group(1).decode('utf-8'), buffer))
+                # >>
+                # If a getter definition syntax or an assignment to ``this``
+                # is found after a comment block, then the comment block documents
+                # that attribute::
+                #
+                #   constructor() {
+                #     // ``true`` if the game is started, ``false`` otherwise.
+                #     this.started = false
+                #   }
+                #
+                #   // The song duration in seconds.
+                #   get duration() {
+                elif line.startswith(b'get ') or line.startswith(b'this.'):
+                    if line[:1] == b'g':
+                        name = line[4:-4] if line.endswith(b'() {') else None
+                    else:
+                        name, eq, _rhs = line[5:].partition(b'=')
+                        name = name.rstrip() if eq else None
+                    if name and self.current_class and _is_word(name):
+                        self.events.append(('attr', None, name.decode('utf-8'), buffer))
+                # >>
+                # If ``export let`` is found after a comment block, then the
+                # comment block documents that module export::
+                #
+                #   // The global SceneManager instance.
+                #   export let instance = new SceneManager()
+                elif line.startswith(b'export let '):
+                    name = line[11:].partition(b'=')[0].rstrip()
+                    if _is_word(name):
+                        self.events.append(('data', self.module_name(), name.decode('utf-8'), buffer))
+                # >>
+                # If ``export function`` is found after a comment block, then the
+                # comment block documents that module export::
+                #
+                #   // The global SceneManager instance.
+                #   export function download() {
+                elif line.startswith(b'export function '):
+                    rest = line[16:]
+                    paren = rest.find(b'(')
+                    close = rest.find(b')', paren)
+                    if paren > 0 and close > paren and _is_word(rest[:paren]):
+                        self.events.append(('data', self.module_name(), rest[:close + 1].decode('utf-8'), buffer))
         elif self.post_state == 'class':
-            if self.match(CONSTRUCTOR_RE):
-                self.current_class.arguments = self.match(1)
+            constructor_match = CONSTRUCTOR_RE.match(line)
+            if constructor_match:
+                self.events.append(('args', None, constructor_match.group(1).decode('utf-8'), None))
+
+class _Buffer(object):
+    # A minimal in-memory writable, for the places that still need the
+    # rendered text as a string (indentation, the table of contents).
+    def __init__(self):
+        self.pieces = []
+        self.write = self.pieces.append
+    def getvalue(self):
+        return ''.join(self.pieces)
 
 class Node(object):
     def __init__(self, *args):
@@ -211,49 +286,65 @@ class Node(object):
     def add(self, item):
         self.contents.append(item)
     def add_text(self, buf):
-        self.contents.append('\n'.join(buf))
-    def text_contents(self):
-        return '\n\n'.join(map(str, self.contents))
+        # ``buf`` comes straight from the binary read; this is the boundary
+        # where the comment lines are decoded into text.
+        self.contents.append(b'\n'.join(buf).decode('utf-8'))
+    def _emit(self, out):
+        # Writes the node's pieces to ``out`` (anything with a ``write``
+        # method) so that rendering streams straight to the output file
+        # instead of materializing the whole document as one string.
+        first = True
+        for item in self.contents:
+            if first:
+                first = False
+            else:
+                out.write('\n\n')
+            if isinstance(item, Node):
+                item._emit(out)
+            else:
+                out.write(item)
     def __str__(self):
-        return self.text_contents()
+        buf = _Buffer()
+        self._emit(buf)
+        return buf.getvalue()
 
 class RootNode(object):
     def __init__(self):
         self.modules = { }
         self.files = { }
     def file(self, file_name, node_type=Node, *args):
-        if file_name in self.files:
-            return self.files[file_name]
-        else:
+        node = self.files.get(file_name)
+        if node is None:
             node = self.files[file_name] = node_type(*args)
-            return node
+        return node
     def module(self, module_name):
-        if module_name in self.modules:
-            return self.modules[module_name]
-        else:
+        node = self.modules.get(module_name)
+        if node is None:
             file_name = 'modules/%s.rst' % module_name
             node = self.modules[module_name] = self.file(file_name, ModuleNode, module_name)
-            return node
+        return node
 
 class ModuleNode(Node):
     def initialize(self, name):
         self.name = name
-    def __str__(self):
-        return (
-            self.name + '\n' +
-            '=' * len(self.name) + '\n' +
-            self.text_contents())
+    def _emit(self, out):
+        out.write(self.name)
+        out.write('\n')
+        out.write('=' * len(self.name))
+        out.write('\n')
+        Node._emit(self, out)
 
 class DomainNode(Node):
     def directive(self):
         pass
     def index(self):
         pass
-    def __str__(self):
-        return (
-            '.. index::\n   single: %s\n\n' % self.index() +
-            '.. %s\n   :noindex:\n\n' % self.directive() +
-            indent3(self.text_contents()))
+    def _emit(self, out):
+        out.write('.. index::\n   single: %s\n\n' % self.index())
+        out.write('.. %s\n   :noindex:\n\n' % self.directive())
+        buf = _Buffer()
+        Node._emit(self, buf)
+        out.write(indent3(buf.getvalue()))
 
 class ClassNode(DomainNode):
     def initialize(self, module, name):
@@ -301,41 +392,110 @@ class DataNode(DomainNode):
     def directive(self):
         return 'js:data:: %s' % (self.name)
 
+def process_one(path):
+    return FileProcessor(path).process()
+
+def build_tree(root, results):
+    # Replays the per-file event streams, in file order, into the shared
+    # node tree. This is the only part that has to be single-threaded.
+    for events in results:
+        current_class = None
+        # Like the old per-FileProcessor state, a '>>' continuation cannot
+        # reach back into another file; a dangling one fails loudly.
+        last_codedoc = None
+        for kind, module_name, name, lines in events:
+            if kind == 'codedoc':
+                node = last_codedoc = root.file('_codedoc/%s.txt' % name)
+                node.add_text(lines)
+            elif kind == 'continue':
+                last_codedoc.add_text(lines)
+            elif kind == 'moduledoc':
+                node = last_codedoc = root.module(module_name)
+                node.add_text(lines)
+            elif kind == 'class':
+                module_node = root.module(module_name)
+                current_class = ClassNode(module_node, name)
+                module_node.add(current_class)
+                current_class.add_text(lines)
+            elif kind == 'method':
+                method_node = MethodNode(current_class, name)
+                method_node.add_text(lines)
+                current_class.add(method_node)
+            elif kind == 'attr':
+                attr_node = AttributeNode(current_class, name)
+                attr_node.add_text(lines)
+                current_class.add(attr_node)
+            elif kind == 'data':
+                module_node = root.module(module_name)
+                data_node = DataNode(module_node, name)
+                data_node.add_text(lines)
+                module_node.add(data_node)
+            elif kind == 'args':
+                current_class.arguments = name
+
 def wtf(filename, contents): # write to file
     try:
-        with open(filename, 'r') as f:
+        with open(filename, 'r', encoding='utf-8') as f:
             old_contents = f.read()
     except IOError as exc:
         if exc.errno == errno.ENOENT:
             old_contents = None
         else:
-            raise exc
+            raise
     if old_contents == contents:
         return
-    print "Write", filename
-    with open(filename, 'w') as f:
+    print("Write", filename)
+    with open(filename, 'w', encoding='utf-8') as f:
         f.write(contents)
 
 def main():
     root = RootNode()
-    for path in get_source_files():
-        processor = FileProcessor(path, root)
-        processor.process()
-    for filename in root.files:
-        mkpath(os.path.dirname(filename))
-        wtf(filename, str(root.files[filename]))
+    paths = list(get_source_files())
+    # Each file parses independently, so farm the parsing out to worker
+    # processes and merge the resulting event streams afterwards.
+    with multiprocessing.Pool() as pool:
+        results = pool.map(process_one, paths)
+    build_tree(root, results)
+    made = set()
+    # Sorted so the files are written in a stable, reproducible order.
+    for filename in sorted(root.files):
+        dirname = os.path.dirname(filename)
+        if dirname and dirname not in made:
+            mkpath(dirname)
+            made.add(dirname)
+        buf = _Buffer()
+        root.files[filename]._emit(buf)
+        data = buf.getvalue().encode('utf-8')
+        # Like wtf, leave the file untouched when the contents did not
+        # change, so Sphinx does not rebuild every dependent document.
+        try:
+            with open(filename, 'rb') as f:
+                old_data = f.read()
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            old_data = None
+        if old_data == data:
+            continue
+        print("Write", filename)
+        # One os.write of the assembled bytes per file; skips building a
+        # TextIOWrapper/BufferedWriter stack for every small output file.
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
     wtf('modules/index.rst', toc(root))
 
 def toc(root):
-    out = []
-    out.append('Modules Index')
-    out.append('=============')
-    out.append('.. toctree::')
-    out.append('   :maxdepth: 2')
-    out.append('')
-    for key in sorted(root.modules):
-        out.append('   ' + key)
-    return '\n'.join(out)
+    lines = [
+        'Modules Index',
+        '=============',
+        '.. toctree::',
+        '   :maxdepth: 2',
+        '']
+    lines.extend('   ' + key for key in sorted(root.modules))
+    return '\n'.join(lines)
 
 if __name__ == '__main__':
     main()